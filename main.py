@@ -1,114 +1,371 @@
-from pdf2image import convert_from_path
-import pytesseract
 import os
-from typing import Optional, List
-from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+# Each worker thread runs its own Tesseract instance, so keep Tesseract's internal
+# OpenMP threading off to avoid oversubscribing cores. Must be set before loading it.
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+import fitz
+from PIL import Image
+from tesserocr import PyTessBaseAPI, PSM, OEM, tesseract_version
+import hashlib
+import logging
+import tempfile
+import threading
+import time
+from collections import deque
+from typing import Iterator, Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Tesseract handles of each OCR worker thread, keyed by (psm, oem)
+_thread_local = threading.local()
+
+# Caps concurrent OCR across every extraction in the process at one page per core
+_ocr_semaphore = threading.BoundedSemaphore(os.cpu_count() or 1)
+
+# PyMuPDF shares one global MuPDF context between all documents and isn't
+# thread-safe, so every call into fitz across extractions goes through this lock
+_fitz_lock = threading.Lock()
+
+OCR_LANG = 'ara'
+OCR_ATTEMPTS = 3
+MAX_CONSECUTIVE_FAILURES = 3  # Pages in a row that may fail OCR before the run is aborted
+
+
+def _get_api(psm: int, oem: int) -> PyTessBaseAPI:
+    """
+    Get the Tesseract handle for the current thread, creating it on first use
+    so the Arabic model is loaded once per worker instead of once per page.
+    The handle is released when the worker thread exits.
+
+    Args:
+        psm (int): Tesseract page segmentation mode
+        oem (int): Tesseract OCR engine mode
+
+    Returns:
+        PyTessBaseAPI: Tesseract handle owned by the current thread
+    """
+    apis = getattr(_thread_local, "apis", None)
+    if apis is None:
+        apis = _thread_local.apis = {}
+    api = apis.get((psm, oem))
+    if api is None:
+        api = apis[(psm, oem)] = PyTessBaseAPI(lang=OCR_LANG, psm=psm, oem=oem)
+    return api
+
+
+def _ocr_page(image: Image.Image, psm: int, oem: int) -> Optional[str]:
+    """
+    Run OCR on a single page image using the current thread's Tesseract handle.
+    Recognition failures are retried with exponential backoff so a transient error
+    (such as running out of memory on a huge page) doesn't fail the whole PDF.
+    Failing to create the handle is a setup problem, like missing language data,
+    and is raised straight away.
+
+    Args:
+        image (Image.Image): Rendered page image
+        psm (int): Tesseract page segmentation mode
+        oem (int): Tesseract OCR engine mode
+
+    Returns:
+        str, optional: Extracted text for the page, or None if every attempt failed
+    """
+    for attempt in range(OCR_ATTEMPTS):
+        with _ocr_semaphore:
+            api = _get_api(psm, oem)
+            try:
+                api.SetImage(image)
+                return api.GetUTF8Text()
+            except (RuntimeError, MemoryError) as e:
+                logger.debug("OCR attempt %d failed: %s", attempt + 1, e)
+                # The handle may be left in a bad state, so start the next attempt with a fresh one
+                _thread_local.apis.pop((psm, oem), None)
+        if attempt + 1 < OCR_ATTEMPTS:
+            time.sleep(2 ** attempt)
+    return None
+
+
+def _remove_file(path: str):
+    """
+    Delete a file with a single unlink. A file that is already gone is ignored and
+    any other failure is logged rather than raised, so cleanup never aborts a run.
+
+    Args:
+        path (str): Path of the file to delete
+    """
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning("Error removing file %s: %s", path, e)
+
+
+class _PageCache:
+    """
+    On-disk cache of OCR text for single pages. Entries are keyed by the PDF's
+    contents, the page number and every setting that changes the OCR result:
+    the caller's rendering and Tesseract settings, the OCR language, the
+    Tesseract version and CACHE_VERSION.
+    """
+
+    # Bump when page preprocessing changes in a way the settings don't capture
+    CACHE_VERSION = 1
+
+    def __init__(self, cache_dir: str, pdf_path: str, settings: tuple):
+        """
+        Args:
+            cache_dir (str): Directory to keep cache entries in, created if missing
+            pdf_path (str): Path to the PDF file whose pages are cached
+            settings (tuple): Every caller setting that changes the OCR result, such as
+                DPI, image size limit, binarization threshold, PSM and OEM
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(pdf_path, "rb") as f:
+            pdf_hash = hashlib.file_digest(f, "sha1").hexdigest()
+        key = (self.CACHE_VERSION, OCR_LANG, tesseract_version()) + tuple(settings)
+        self.cache_dir = cache_dir
+        self.pdf_hash = pdf_hash
+        self.settings = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:16]
+
+    def _path(self, page_num: int) -> str:
+        """
+        Get the path of a page's cache entry.
+
+        Args:
+            page_num (int): Page number, starting from 1
+
+        Returns:
+            str: Path of the entry, whether or not it exists
+        """
+        return os.path.join(self.cache_dir, f"{self.pdf_hash}_{page_num}_{self.settings}.txt")
+
+    def get(self, page_num: int) -> Optional[str]:
+        """
+        Get the cached text for a page and mark the entry as recently used.
+
+        Args:
+            page_num (int): Page number, starting from 1
+
+        Returns:
+            str, optional: Cached text for the page, or None on a miss
+        """
+        path = self._path(page_num)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+        except FileNotFoundError:
+            return None
+        # Mark the entry as recently used for eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted by another run since it was read; the text is still good
+            pass
+        return text
+
+    def put(self, page_num: int, text: str):
+        """
+        Store the text for a page. Written to a temporary file first and renamed
+        into place, so a crash never leaves a partial entry behind.
+
+        Args:
+            page_num (int): Page number, starting from 1
+            text (str): Extracted text for the page
+        """
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(temp_path, self._path(page_num))
+        except BaseException:
+            _remove_file(temp_path)
+            raise
+
+    def evict(self, max_bytes: int):
+        """
+        Delete the least recently used entries until the cache fits in max_bytes.
+
+        Args:
+            max_bytes (int): Total size of the entries to keep, in bytes
+        """
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith(".txt"):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        # Evicted by another run since the directory was listed
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            _remove_file(path)
+            total -= size
+
 
 class PDFTextExtractor:
-    def __init__(self):
-        self.is_running = False
+    def __init__(self, psm: int = PSM.SINGLE_BLOCK, oem: int = OEM.LSTM_ONLY,
+                 cache_dir: Optional[str] = "cache", cache_max_bytes: int = 100 * 1024 * 1024):
+        """
+        The extractor only holds configuration, so a single instance can run several
+        extractions at once, e.g. from multiple threads. OCR runs in parallel across
+        them, but page rendering is serialized since PyMuPDF isn't thread-safe.
+        
+        Args:
+            psm (int): Tesseract page segmentation mode. Defaults to a single block
+                of text, which suits body-text pages and is faster than full layout analysis
+            oem (int): Tesseract OCR engine mode. Defaults to the LSTM engine only
+            cache_dir (str, optional): Directory to cache OCR text per page in, so reruns
+                on the same PDF skip rendering and OCR. None disables the cache
+            cache_max_bytes (int): Size the cache is trimmed back to after each extraction
+        """
+        self.psm = psm
+        self.oem = oem
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
 
-    def extract_text_from_pdf(self, pdf_path: str, max_pages: Optional[int] = None, start_page: int = 1, save_images: bool = False) -> List[str]:
+    def extract_text_from_pdf(self, pdf_path: str, max_pages: Optional[int] = None, start_page: int = 1, save_images: bool = False, dpi: int = 150) -> Iterator[str]:
         """
-        Extract text from a PDF file using OCR.
+        Extract text from a PDF file using OCR. Pages are yielded as soon as they're
+        done, so callers can stream them without holding the whole document in memory.
         
         Args:
             pdf_path (str): Path to the PDF file
             max_pages (int, optional): Maximum number of pages to process. If None, processes all pages
-            save_images (bool): Whether to save the intermediate images or clean them up
+            save_images (bool): Whether to also save the rendered page images to output/
+            dpi (int): Resolution to render pages at before OCR
             
-        Returns:
-            List[str]: List of extracted text strings, one per page
+        Yields:
+            str: Extracted text of each page, in page order
         """
-        if self.is_running:
-            raise RuntimeError("Please wait for the previous extraction to finish.")
-
-        self.is_running = True
+        logger.info("Extracting text from PDF: %s", pdf_path)
+        if not os.path.exists(pdf_path):
+            raise FileNotFoundError(f"PDF file not found: {pdf_path}")
+            
+        save_futures = []
+        BATCH_SIZE = 10
+        MAX_IMAGE_SIZE = 2500  # Largest page dimension handed to OCR, in pixels
+        BINARIZE_THRESHOLD = 155  # Gray levels below this become black
+        
+        cache = None
         try:
-            print(f"Extracting text from PDF: {pdf_path}")
-            if not os.path.exists(pdf_path):
-                raise FileNotFoundError(f"PDF file not found: {pdf_path}")
-                
-            extracted_text = []
-            temp_image_paths = []
-            BATCH_SIZE = 10
+            if self.cache_dir:
+                cache = _PageCache(self.cache_dir, pdf_path,
+                                   (dpi, MAX_IMAGE_SIZE, BINARIZE_THRESHOLD, int(self.psm), int(self.oem)))
+            if save_images:
+                os.makedirs("output", exist_ok=True)
             
+            # Open the PDF once and render every page from the same handle.
+            # The page count is read from the document's metadata, no rendering needed.
+            with _fitz_lock:
+                doc = fitz.open(pdf_path)
+                total_pages = doc.page_count
             try:
-                # Get first page to determine total pages if we don't have max_pages
-                if max_pages is None:
-                    with ThreadPoolExecutor() as executor:
-                        future = executor.submit(convert_from_path, pdf_path, 
-                                              first_page=1, 
-                                              last_page=1,
-                                              dpi=200, fmt='png')
-                        first_page = future.result(timeout=10)
-                        if not first_page:
-                            raise Exception("Could not read the PDF file")
-                        total_pages = len(first_page)
-                else:
-                    total_pages = max_pages+start_page-1
-                print(f"Processing until page {total_pages} in batches of {BATCH_SIZE}")
-                # Process pages in batches, starting from start_page
-                for batch_start in range(start_page, total_pages + 1, BATCH_SIZE):
-                    end_page = min(batch_start + BATCH_SIZE - 1, total_pages)
-                    print(f"Processing batch: pages {batch_start} to {end_page}")
-                    
-                    # Convert batch of pages with timeout
-                    with ThreadPoolExecutor() as executor:
-                        future = executor.submit(convert_from_path, pdf_path, 
-                                              first_page=batch_start, 
-                                              last_page=end_page,
-                                              dpi=200, fmt='png')
-                        page_images = future.result(timeout=30)  # 30 second timeout per batch
-                        if not page_images:
-                            print(f"No images generated for pages {batch_start}-{end_page}")
-                            continue
-                            
-                        # Process each page in the batch
-                        for i, image in enumerate(page_images):
-                            page_num = batch_start + i  # Calculate actual page number
-                            # Save temporary image
-                            temp_image_path = f"output/temp_page_{page_num}.png"
-                            print(f"Saving temporary image: {temp_image_path}")
-                            image.save(temp_image_path)
-                            temp_image_paths.append(temp_image_path)
-                            
-                            # Extract text using OCR with Arabic language
-                            text = pytesseract.image_to_string(image, lang='ara', config='--psm 3')
-                            print(f"Extracted text from page {page_num}")
-                            extracted_text.append(text)
+                # Never go past the last page, even if max_pages asks to
+                if max_pages is not None:
+                    total_pages = min(total_pages, max_pages+start_page-1)
+                logger.info("Processing until page %d, up to %d pages in flight", total_pages, BATCH_SIZE)
+                # Pages are independent, so OCR them in parallel across all cores.
+                # tesserocr releases the GIL during recognition, so threads suffice.
+                # Saved images are written in the background so they overlap OCR.
+                with ThreadPoolExecutor(max_workers=os.cpu_count()) as ocr_executor, \
+                        ThreadPoolExecutor(max_workers=1) as save_executor:
+                    # Render the next page while earlier ones are being OCR'd. At most
+                    # BATCH_SIZE pages are queued, which bounds memory use.
+                    pending = deque()
+                    consecutive_failures = 0
+                    try:
+                        for page_num in range(start_page, total_pages + 1):
+                            # Skip rendering and OCR for pages already in the cache, unless the
+                            # page image itself was asked for
+                            cached_text = cache.get(page_num) if cache and not save_images else None
+                            if cached_text is not None:
+                                logger.debug("Using cached text for page %d", page_num)
+                                future = Future()
+                                future.set_result(cached_text)
+                            else:
+                                # Render the page in-process straight to a grayscale PIL image
+                                with _fitz_lock:
+                                    pix = doc[page_num - 1].get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+                                    gray = Image.frombytes("L", (pix.width, pix.height), pix.samples)
+                                    # The image has its own copy of the pixels, so release the pixmap now
+                                    del pix
+                                # Downsample oversized pages, which cost far more OCR time than they gain
+                                gray.thumbnail((MAX_IMAGE_SIZE, MAX_IMAGE_SIZE), Image.LANCZOS)
+                                # Binarize so Tesseract gets a 1-bit bitmap and can skip its own thresholding
+                                image = gray.point(lambda x: 0 if x < BINARIZE_THRESHOLD else 255, '1')
+                                gray.close()
+                                if save_images:
+                                    image_path = os.path.join("output", f"page_{page_num}.png")
+                                    logger.debug("Saving image: %s", image_path)
+                                    # Pillow's save() writes encoder state onto the image, and tesserocr
+                                    # saves the same image during OCR, so the save gets its own copy
+                                    save_futures.append(save_executor.submit(image.copy().save, image_path, compress_level=1))
+                                future = ocr_executor.submit(_ocr_page, image, self.psm, self.oem)
+                                # From here only the OCR and save tasks hold the page, so its
+                                # buffer is freed as soon as they finish rather than lingering
+                                # until the next page is rendered
+                                del image
+                            pending.append((page_num, future, cached_text is not None))
                             
-                            # Clean up the temporary image immediately if not saving
-                            if not save_images and os.path.exists(temp_image_path):
-                                try:
-                                    os.remove(temp_image_path)
-                                    temp_image_paths.remove(temp_image_path)
-                                except Exception as e:
-                                    print(f"Error cleaning up temporary file {temp_image_path}: {str(e)}")
-                
-            except TimeoutError as te:
-                print(f"Timeout error: {str(te)}")
-                raise Exception("PDF processing timed out. The file might be too large or corrupt.")
-            except Exception as e:
-                print(f"Error processing PDF: {str(e)}")
-                raise
-
+                            # Collect the oldest page once the queue is full (or rendering is
+                            # done), so text is extracted in page order
+                            while pending and (len(pending) >= BATCH_SIZE or page_num == total_pages):
+                                done_page, future, from_cache = pending.popleft()
+                                text = future.result()
+                                if text is None:
+                                    # Several failures in a row point to a real problem rather than
+                                    # one bad page, so stop instead of writing an empty document
+                                    consecutive_failures += 1
+                                    if consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+                                        raise RuntimeError(f"OCR failed on {consecutive_failures} pages in a row, "
+                                                           f"last was page {done_page}")
+                                    # Keep going without the page rather than failing the whole PDF
+                                    logger.warning("OCR failed for page %d after %d attempts, leaving it empty",
+                                                   done_page, OCR_ATTEMPTS)
+                                    text = ""
+                                else:
+                                    consecutive_failures = 0
+                                    if cache and not from_cache:
+                                        try:
+                                            cache.put(done_page, text)
+                                        except OSError as e:
+                                            # The OCR succeeded, so a full or read-only cache shouldn't fail the run
+                                            logger.warning("Error caching text for page %d: %s", done_page, e)
+                                logger.debug("Extracted text from page %d", done_page)
+                                yield text
+                    finally:
+                        # Cancel OCR that hasn't started when stopping early (on an error, or
+                        # when the caller stops iterating), so shutting the executor down
+                        # doesn't wait on pages nobody will read
+                        for _, queued, _ in pending:
+                            queued.cancel()
             finally:
-                # Clean up temporary images if not saving
-                if not save_images:
-                    for temp_path in temp_image_paths:
-                        if os.path.exists(temp_path):
-                            try:
-                                os.remove(temp_path)
-                            except Exception as e:
-                                print(f"Error cleaning up temporary file {temp_path}: {str(e)}")
+                with _fitz_lock:
+                    doc.close()
             
-            return extracted_text
-
+            # Surface any error raised while saving images
+            for future in save_futures:
+                future.result()
+            
+        except Exception as e:
+            logger.error("Error processing PDF: %s", e)
+            raise
+        
         finally:
-            self.is_running = False
+            # Trim the cache even when stopping early, since pages may have been added
+            if cache:
+                try:
+                    cache.evict(self.cache_max_bytes)
+                except OSError as e:
+                    logger.warning("Error trimming cache %s: %s", cache.cache_dir, e)
             
-    def get_text_from_pdf(self, pdf_path: str, max_pages: Optional[int] = None, start_page: int = 1) -> str:
+    def get_text_from_pdf(self, pdf_path: str, max_pages: Optional[int] = None, start_page: int = 1, dpi: int = 150) -> str:
         """
         Convenience method to get all text from PDF as a single string.
         
@@ -116,41 +373,27 @@ class PDFTextExtractor:
             pdf_path (str): Path to the PDF file
             max_pages (int, optional): Maximum number of pages to process
             start_page (int): The page to start processing from
+            dpi (int): Resolution to render pages at before OCR
             
         Returns:
             str: Concatenated text from all processed pages
         """
-        text_list = self.extract_text_from_pdf(pdf_path, max_pages, start_page=start_page)
-        return "\n\n".join(text_list)
+        return "\n\n".join(self.extract_text_from_pdf(pdf_path, max_pages, start_page=start_page, dpi=dpi))
 
 
-    def convert_to_text(self, pdf_path: str, max_pages: int = None) -> str:
+    def convert_to_text(self, pdf_path: str, max_pages: int = None, dpi: int = 150) -> str:
         """
         Creates a text file from a PDF file using OCR.
-        Processes text in chunks of 10 pages to manage requests better.
+        Pages are written to the file as they finish and flushed every 10 pages.
         
         Args:
             pdf_path (str): Path to the PDF file
             max_pages (int, optional): Maximum number of pages to process
+            dpi (int): Resolution to render pages at before OCR
             
         Returns:
-            nd_page = min(start_page + CHUNK_SIZE - 1, max_pages)
-            print(f"\nProcessing pages {start_page} to {end_page}")
-            
-            # Extract text for this chunk
-            chunk_text = pdf_extractor.get_text_from_pdf(pdf_path, max_pages=CHUNK_SIZE, start_page=start_page)
-            
-            # Save chunk text to file
-            chunk_filename = f"{os.path.splitext(os.path.basename(pdf_path))[0]}_text_chunk_{chunk_number}.txt"
-            chunk_path = os.path.join("output", chunk_filename)
-            with open(chunk_path, "w", encoding="utf-8") as f:
-                f.write(chunk_text)
-            print(f"Saved chunk {chunk_number} text to: {chunk_path}")str: Generated study guide
-        """
-        CHUNK_SIZE = 10  # Process 10 pages at a time
-        all_text = []
-        chunk_number = 1
-        
+            str: Path to the written text file
+        """
         # Create base prompt for the study guide
         base_prompt = """
         In ARABIC, Create a study guide for this section. The guide should be organized by
@@ -160,38 +403,38 @@ class PDFTextExtractor:
         Response should be detailed and thorough.
         Use the text provided. DO NOT GIVE A SHORT RESPONSE!"""
         
-        # Process PDF in chunks
-        for start_page in range(1, max_pages + 1, CHUNK_SIZE):
-            end_page = min(start_page + CHUNK_SIZE - 1, max_pages)
-            print(f"\nProcessing pages {start_page} to {end_page}")
-            
-            # Extract text for this chunk
-            chunk_text = self.get_text_from_pdf(pdf_path, max_pages=CHUNK_SIZE, start_page=start_page)
-
-            all_text.append(chunk_text)
-            
-            chunk_number += 1
-        
-        # Combine all chunks into final study guide
-        if not all_text:
-            return "Failed to generate study guide."
-
-        final_text = "\n\n".join(all_text)
-
-        # Save complete text
         output_filename = os.path.splitext(os.path.basename(pdf_path))[0] + "_output.txt"
         output_path = os.path.join("output", output_filename)
-        with open(output_path, "w", encoding="utf-8") as f:
-            f.write(final_text)
+        os.makedirs("output", exist_ok=True)
+        
+        FLUSH_EVERY = 10  # Pages written between flushes
+        
+        # Extract the first page before opening the output file, so a bad path or an OCR
+        # setup error fails without truncating the output of an earlier run
+        pages = self.extract_text_from_pdf(pdf_path, max_pages, start_page=1, dpi=dpi)
+        first_page = next(pages, None)
+        
+        # Stream each page to the file as it's extracted so memory stays bounded to
+        # a single page, and flush regularly so a crash mid-document keeps the finished pages
+        with open(output_path, "w", encoding="utf-8", buffering=1 << 20) as f:
+            if first_page is not None:
+                f.write(first_page)
+            for page_count, text in enumerate(pages, start=2):
+                f.write("\n\n")
+                f.write(text)
+                if page_count % FLUSH_EVERY == 0:
+                    f.flush()
 
-        return final_text
+        return output_path
 
 
 def main():
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     pdf_path = input("Enter the path to the PDF file: ")
     max_pages = int(input("Enter the maximum number of pages to process: "))  # Set the maximum number of pages to process
     pdf_extractor = PDFTextExtractor()
-    pdf_extractor.convert_to_text(pdf_path, max_pages)
+    output_path = pdf_extractor.convert_to_text(pdf_path, max_pages)
+    print(f"Saved text to: {output_path}")
     print("All done. Thank you for using Shaykh Salih Technologies")
     
 